@@ -3,29 +3,191 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def _split_like(flat, params):
+    # views of `flat` shaped like each of `params`, in order
+    return [chunk.view_as(param) for chunk, param in zip(flat.split([p.numel() for p in params]), params)]
+
+
+def _fgm_scale(norm, epsilon):
+    # epsilon / norm, or 0 where the norm is zero or not finite; computed on
+    # device, so the guard never needs the norm on the host
+    finite = torch.isfinite(norm) & (norm > 0)
+    return torch.where(finite, epsilon / norm.clamp_min(1e-12), torch.zeros_like(norm))
+
+
+def _fgm_mask_(r_at, scale):
+    # a zero scale alone does not skip the step: inf/nan grad entries times 0
+    # are still nan, so the step itself is zeroed (the 0-dim mask broadcasts,
+    # no sync)
+    return r_at.masked_fill_(scale == 0, 0)
+
+
+def _fgm_perturb(params, grads, epsilon, norms, flat):
+    # each grad is reduced in fp32 straight into its slot of the persistent
+    # `norms` buffer, the rest is handled by multi-tensor kernels so adding
+    # word + position + token_type embeddings costs no extra launches
+    for i, grad in enumerate(grads):
+        torch.linalg.vector_norm(grad, dtype=torch.float32, out=norms[i])
+    scales = _fgm_scale(norms, epsilon)
+    # the adversarial backward overwrites param.grad, so the applied perturbation
+    # itself is written into `flat` (one contiguous buffer for all tables) and
+    # subtracted again in restore
+    torch.cat([grad.reshape(-1) for grad in grads], out=flat)
+    r_ats = _split_like(flat, params)
+    torch._foreach_mul_(r_ats, [scale.to(flat.dtype) for scale in scales.unbind()])
+    for r_at, scale in zip(r_ats, scales.unbind()):
+        _fgm_mask_(r_at, scale)
+    torch._foreach_add_(params, r_ats)
+
+
 class FGM():
-    def __init__(self, model):
+    def __init__(self, model, emb_name='bert.embeddings.word_embeddings.', offload=False, compile=False):
+        # emb_name should be consistent with name in actual model, a tuple
+        # targets several embedding tables at once
+        # offload keeps the perturbation in pinned host memory between attack and
+        # restore, freeing its GPU copy during the adversarial forward/backward
+        # compile fuses the norm and the scaled add into one pass with torch.compile
+        if isinstance(emb_name, str):
+            emb_name = (emb_name,)
         self.model = model
-        self.backup = {}
+        # the target parameters never change during training, so look them up once
+        # and keep only the tensors
+        self._target_params = [param for name, param in model.named_parameters()
+                               if param.requires_grad and any(n in name for n in emb_name)]
+        # sparse (indices, rows) backups, aligned with self._target_params
+        self._backup_list = [None] * len(self._target_params)
+        if len({(param.dtype, param.device) for param in self._target_params}) > 1:
+            raise ValueError("FGM target parameters must share one dtype and device.")
+        self.offload = offload
+        # dense perturbations of all tables live in one flat buffer (plus its
+        # pinned host mirror when offloading), so backup/restore is one copy
+        self._flat = None
+        self._host_flat = None
+        self._dense = None
+        self._norm_buf = None
+        self._graph = None
+        self._static_grads = None
+        # sparse tables are updated one by one, so each gets its own side stream
+        # and the small, independent updates can overlap
+        self._streams = None
+        if len(self._target_params) > 1 and self._target_params[0].is_cuda:
+            self._streams = [torch.cuda.Stream(device=param.device) for param in self._target_params]
+        if self._target_params:
+            self._norm_buf = torch.empty(len(self._target_params), dtype=torch.float32,
+                                         device=self._target_params[0].device)
+        if compile and hasattr(torch, 'compile'):
+            self._perturb = torch.compile(_fgm_perturb, dynamic=False)
+        else:
+            self._perturb = _fgm_perturb
+
+    @torch.no_grad()
+    def attack(self, epsilon=1.0):
+        dense, sparse = [], []
+        for i, param in enumerate(self._target_params):
+            if param.grad.is_sparse:
+                sparse.append(i)
+            else:
+                dense.append(param)
+        if dense:
+            self._attack_dense(dense, epsilon)
+        if len(sparse) > 1 and self._streams is not None:
+            main = torch.cuda.current_stream()
+            for i, stream in zip(sparse, self._streams):
+                stream.wait_stream(main)
+                with torch.cuda.stream(stream):
+                    self._backup_list[i] = self._attack_sparse(self._target_params[i], epsilon)
+                    indices, rows = self._backup_list[i]
+                    # restore reads these on the main stream
+                    indices.record_stream(main)
+                    rows.record_stream(main)
+            for stream in self._streams[:len(sparse)]:
+                main.wait_stream(stream)
+        else:
+            for i in sparse:
+                self._backup_list[i] = self._attack_sparse(self._target_params[i], epsilon)
+
+
+    @torch.no_grad()
+    def restore(self):
+        for i, backup in enumerate(self._backup_list):
+            if backup is not None:
+                indices, rows = backup
+                self._target_params[i].index_add_(0, indices, rows, alpha=-1)
+                self._backup_list[i] = None
+        if self._dense is not None:
+            params, flat = self._dense
+            flat = flat.to(params[0].device, non_blocking=True)
+            torch._foreach_sub_(params, _split_like(flat, params))
+            self._dense = None
 
-    def attack(self, epsilon=1.0, emb_name='bert.embeddings.word_embeddings.'):
-        # emb_name should be consistent with name in actual model
-        cos = torch.nn.CosineSimilarity(dim=1, eps=1e-6)
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and emb_name in name:
-                self.backup[name] = param.data.clone()
-                norm = torch.norm(param.grad)
-                if norm != 0 and not torch.isnan(norm):
-                    r_at = epsilon * param.grad / norm
-                    param.data.add_(r_at)
+    @torch.no_grad()
+    def build_graphs(self, epsilon=1.0):
+        """Captures the dense attack update for `epsilon` in a CUDA graph.
 
+        Later `attack(epsilon)` calls copy the current grads into the captured
+        input buffers (or find them already there) and replay the graph instead
+        of launching each kernel.
+        """
+        params = self._target_params
+        if self.offload or not params or not params[0].is_cuda or \
+                any(param.grad is not None and param.grad.is_sparse for param in params):
+            raise ValueError("CUDA graphs need dense CUDA targets without offload.")
+        self._flat = torch.empty(sum(param.numel() for param in params), dtype=params[0].dtype,
+                                 device=params[0].device)
+        # zero grads give a zero step, so the warmup run leaves the weights unchanged
+        self._static_grads = [torch.zeros_like(param) for param in params]
+        norms = self._norm_buf[:len(params)]
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            _fgm_perturb(params, self._static_grads, epsilon, norms, self._flat)
+        torch.cuda.current_stream().wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            _fgm_perturb(params, self._static_grads, epsilon, norms, self._flat)
+        self._graph = (graph, epsilon)
 
-    def restore(self, emb_name='bert.embeddings.word_embeddings.'):
-        # emb_name should be consistent with name in actual model
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and emb_name in name:
-                assert name in self.backup
-                param.data = self.backup[name]
-        self.backup = {}
+    def _attack_dense(self, params, epsilon):
+        if self._graph is not None and self._graph[1] == epsilon:
+            for param, static_grad in zip(params, self._static_grads):
+                if param.grad is not static_grad:
+                    # hand the captured buffer to autograd, later backwards
+                    # accumulate into it directly
+                    static_grad.copy_(param.grad)
+                    param.grad = static_grad
+            self._graph[0].replay()
+            self._dense = (params, self._flat)
+            return
+        grads = [param.grad.to(param.dtype) for param in params]
+        numel = sum(param.numel() for param in params)
+        if self.offload and params[0].is_cuda:
+            # only the pinned mirror is kept, the device buffer is released as
+            # soon as it goes out of scope
+            flat = torch.empty(numel, dtype=params[0].dtype, device=params[0].device)
+        else:
+            if self._flat is None or self._flat.numel() != numel:
+                self._flat = torch.empty(numel, dtype=params[0].dtype, device=params[0].device)
+            flat = self._flat
+        self._perturb(params, grads, epsilon, self._norm_buf[:len(params)], flat)
+        if self.offload and flat.is_cuda:
+            flat = self._to_host(flat)
+        self._dense = (params, flat)
 
+    def _attack_sparse(self, param, epsilon):
+        # a sparse embedding grad only has rows for the tokens in the batch, so
+        # only those rows are perturbed and remembered
+        grad = param.grad.coalesce()
+        indices = grad.indices()[0]
+        values = grad.values().to(param.dtype)
+        norm = torch.linalg.vector_norm(values, dtype=torch.float32)
+        scale = _fgm_scale(norm, epsilon)
+        rows = _fgm_mask_(values.mul(scale.to(param.dtype)), scale)
+        param.index_add_(0, indices, rows)
+        return indices, rows
 
+    def _to_host(self, flat):
+        # the pinned buffer is allocated once and reused by every step
+        if self._host_flat is None or self._host_flat.numel() != flat.numel():
+            self._host_flat = torch.empty(flat.shape, dtype=flat.dtype, device='cpu', pin_memory=True)
+        self._host_flat.copy_(flat, non_blocking=True)
+        return self._host_flat
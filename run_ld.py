@@ -19,11 +19,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import copy
 import csv
+import functools
+import hashlib
 import os
 import logging
 import argparse
+import contextlib
+import multiprocessing
 import random
 import sys
 
@@ -32,15 +35,30 @@ from tqdm import tqdm, trange
 from sklearn.metrics import f1_score
 import numpy as np
 import torch
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import Dataset, Sampler, TensorDataset, DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 
 from pytorch_pretrained_bert.tokenization import BertTokenizer
-from pytorch_pretrained_bert.modeling import BertForSequenceClassification
+from pytorch_pretrained_bert.modeling import BertConfig, BertForSequenceClassification, CONFIG_NAME
 from pytorch_pretrained_bert.optimization import BertAdam
 from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
 from at import FGM
 
+try:
+    from transformers import BertTokenizerFast
+except ImportError:
+    BertTokenizerFast = None
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
@@ -70,7 +88,14 @@ class InputExample(object):
 
 
 class InputFeatures(object):
-    """A single set of features of data."""
+    """Features of a set of examples, stored column-wise.
+
+    `input_ids` (int32), `input_mask` (bool) and `segment_ids` (int8) are
+    arrays of shape [num_examples, max_seq_length] and `label_id` is an int64
+    array of shape [num_examples], so they can be handed to torch without
+    copying. The narrow types keep the host copies and the host-to-device
+    traffic small; batches are widened to int64 once they are on the device.
+    """
 
     def __init__(self, input_ids, input_mask, segment_ids, label_id):
         self.input_ids = input_ids
@@ -78,6 +103,23 @@ class InputFeatures(object):
         self.segment_ids = segment_ids
         self.label_id = label_id
 
+    def __len__(self):
+        return len(self.label_id)
+
+    def __getitem__(self, index):
+        """Selects the examples at `index` (an index array, mask or slice)."""
+        return InputFeatures(input_ids=self.input_ids[index],
+                             input_mask=self.input_mask[index],
+                             segment_ids=self.segment_ids[index],
+                             label_id=self.label_id[index])
+
+    @classmethod
+    def concat(cls, features_list):
+        return cls(input_ids=np.concatenate([f.input_ids for f in features_list]),
+                   input_mask=np.concatenate([f.input_mask for f in features_list]),
+                   segment_ids=np.concatenate([f.segment_ids for f in features_list]),
+                   label_id=np.concatenate([f.label_id for f in features_list]))
+
 
 class DataProcessor(object):
     """Base class for data converters for sequence classification data sets."""
@@ -104,6 +146,9 @@ class DataProcessor(object):
     @classmethod
     def _read_tsv(cls, input_file, quotechar=None):
         """Reads a tab separated value file."""
+        lines = cls._read_with_pandas(input_file, "\t", quotechar)
+        if lines is not None:
+            return lines
         with open(input_file, "r", encoding='utf-8') as f:
             reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
             lines = []
@@ -114,13 +159,9 @@ class DataProcessor(object):
     @classmethod
     def _read_csv(cls, input_file, quotechar=None):
         """Reads a comma separated value file."""
-        # import pandas as pd
-        # df = pd.read_csv(input_file)
-        # lines = []
-        # for (i, row) in df.iterrows():
-        #     import ipdb
-        #     ipdb.set_trace()
-        #     lines.append(row)
+        lines = cls._read_with_pandas(input_file, ",", '"')
+        if lines is not None:
+            return lines
         with open(input_file, "r", encoding='utf-8') as f:
             reader = csv.reader(f, delimiter=",")
             lines = []
@@ -128,6 +169,27 @@ class DataProcessor(object):
                 lines.append(line)
             return lines
 
+    @classmethod
+    def _read_with_pandas(cls, input_file, delimiter, quotechar):
+        """Parses a delimited file with the pandas C parser, or returns None if
+        pandas is not installed or cannot parse it (e.g. a row longer than the
+        first one). Rows shorter than the first are padded with '', where
+        csv.reader would return them short."""
+        if pd is None:
+            return None
+        try:
+            # na_filter=False keeps empty fields as '' instead of NaN; no
+            # quotechar means quotes are literal, like csv.reader(quotechar=None)
+            df = pd.read_csv(input_file, sep=delimiter, header=None, dtype=str, na_filter=False,
+                             quoting=csv.QUOTE_NONE if quotechar is None else csv.QUOTE_MINIMAL,
+                             quotechar=quotechar or '"', encoding='utf-8', engine='c')
+        except pd.errors.EmptyDataError:
+            # csv.reader gives no rows for an empty file
+            return []
+        except pd.errors.ParserError:
+            return None
+        return df.values.tolist()
+
 
 class MLDProcessor(DataProcessor):
     """Processor for the MultiNLI data set (GLUE version)."""
@@ -172,21 +234,13 @@ class MLDProcessor(DataProcessor):
     def get_dev_examples(self, data_dir):
         """See base class."""
         src_lines = self._read_tsv(os.path.join(data_dir, self.lang + ".dev"))
-        trg_lines = self._read_tsv(os.path.join(data_dir, "english.dev"))
         src_examples = []
-        trg_examples = []
         for (i, line) in enumerate(src_lines):
             guid = "dev-%d" % (i)
             text_a = line[1]
             label = line[0]
             src_examples.append(
                 InputExample(guid=guid, text_a=text_a, label=label))
-        for (i, line) in enumerate(trg_lines):
-            guid = "dev-%d" % (i)
-            text_a = line[1]
-            label = line[0]
-            trg_examples.append(
-                InputExample(guid=guid, text_a=text_a, label=label))
 
         return src_examples
 
@@ -194,7 +248,6 @@ class MLDProcessor(DataProcessor):
         """See base class."""
         src_lines = self._read_tsv(os.path.join(data_dir, self.lang + ".test"))
         src_examples = []
-        trg_examples = []
         for (i, line) in enumerate(src_lines):
             guid = "test-%d" % (i)
             text_a = line[1]
@@ -242,16 +295,8 @@ class CLYProcessor(DataProcessor):
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        src_lines = self._read_tsv(os.path.join(data_dir, "en_yelp_dev.tsv"))
         trg_lines = self._read_tsv(os.path.join(data_dir, "zh_hotel_test.tsv"))
-        src_examples = []
         trg_examples = []
-        for (i, line) in enumerate(src_lines):
-            guid = "dev-%d" % (i)
-            text_a = line[1]
-            label = line[0]
-            src_examples.append(
-                InputExample(guid=guid, text_a=text_a, label=label))
         for (i, line) in enumerate(trg_lines):
             guid = "dev-%d" % (i)
             text_a = line[1]
@@ -267,12 +312,72 @@ class CLYProcessor(DataProcessor):
 
 
 
-def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer):
-    """Loads a data file into a list of `InputBatch`s."""
+def label_ids_of(examples, label_list):
+    """Index in `label_list` of every example's label, as an int64 array."""
+    if not examples:
+        return np.zeros(0, dtype=np.int64)
+    label_arr = np.array(label_list)
+    # label_list is in label-id order, not sorted, so search its sorted copy
+    # and map the positions back
+    order = np.argsort(label_arr, kind='stable')
+    labels = np.array([example.label for example in examples])
+    pos = np.searchsorted(label_arr[order], labels).clip(max=len(label_arr) - 1)
+    unknown = label_arr[order][pos] != labels
+    if unknown.any():
+        raise KeyError(examples[np.flatnonzero(unknown)[0]].label)
+    return order[pos].astype(np.int64)
+
+
+def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, num_workers=1, num_logged=5):
+    """Loads a data file into an `InputFeatures` of all examples.
 
-    label_map = {label: i for i, label in enumerate(label_list)}
+    With a slow (pure Python) tokenizer and `num_workers` > 1 the examples are
+    tokenized in chunks by a pool of worker processes. The first `num_logged`
+    examples are logged.
+    """
 
-    features = []
+    label_ids = label_ids_of(examples, label_list)
+
+    # pairs stay on the per-example path: the backend's longest_first breaks
+    # ties between the two texts differently from _truncate_seq_pair
+    if getattr(tokenizer, 'is_fast', False) and examples and not any(example.text_b for example in examples):
+        return _convert_examples_to_features_fast(examples, label_ids, max_seq_length, tokenizer, num_logged)
+
+    if num_workers > 1 and len(examples) >= 4 * num_workers:
+        # several chunks per worker to even out long and short documents,
+        # only the first chunk logs its leading examples
+        bounds = np.linspace(0, len(examples), 4 * num_workers + 1).astype(int)
+        chunks = [(examples[start:end], label_ids[start:end], num_logged if start == 0 else 0)
+                  for start, end in zip(bounds[:-1], bounds[1:])]
+        with multiprocessing.Pool(num_workers, initializer=_init_convert_worker,
+                                  initargs=(tokenizer, max_seq_length)) as pool:
+            return InputFeatures.concat(pool.starmap(_convert_chunk, chunks))
+
+    return _convert_examples_to_features_slow(examples, label_ids, max_seq_length, tokenizer, num_logged)
+
+
+# tokenizer and sequence length of a tokenization worker, set once per process
+_convert_worker_state = {}
+
+
+def _init_convert_worker(tokenizer, max_seq_length):
+    _convert_worker_state['tokenizer'] = tokenizer
+    _convert_worker_state['max_seq_length'] = max_seq_length
+
+
+def _convert_chunk(examples, label_ids, num_logged):
+    return _convert_examples_to_features_slow(examples, label_ids, _convert_worker_state['max_seq_length'],
+                                              _convert_worker_state['tokenizer'], num_logged)
+
+
+def _convert_examples_to_features_slow(examples, label_ids, max_seq_length, tokenizer, num_logged=5):
+    """Per-example conversion, for slow tokenizers and sequence pairs."""
+
+    # zero-initialized, so everything past each example's tokens is already padding
+    features = InputFeatures(input_ids=np.zeros((len(examples), max_seq_length), dtype=np.int32),
+                             input_mask=np.zeros((len(examples), max_seq_length), dtype=bool),
+                             segment_ids=np.zeros((len(examples), max_seq_length), dtype=np.int8),
+                             label_id=label_ids)
     for (ex_index, example) in enumerate(examples):
         tokens_a = tokenizer.tokenize(example.text_a)
 
@@ -307,45 +412,126 @@ def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer
         # used as as the "sentence vector". Note that this only makes sense because
         # the entire model is fine-tuned.
         tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
-        segment_ids = [0] * len(tokens)
+        len_a = len(tokens)
 
         if tokens_b:
             tokens += tokens_b + ["[SEP]"]
-            segment_ids += [1] * (len(tokens_b) + 1)
 
         input_ids = tokenizer.convert_tokens_to_ids(tokens)
+        assert len(input_ids) <= max_seq_length
 
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1] * len(input_ids)
+        # Write the real tokens into the zero-padded rows. The mask has 1 for
+        # real tokens and 0 for padding tokens. Only real tokens are attended to.
+        features.input_ids[ex_index, :len(input_ids)] = input_ids
+        features.input_mask[ex_index, :len(input_ids)] = 1
+        features.segment_ids[ex_index, len_a:len(input_ids)] = 1
 
-        # Zero-pad up to the sequence length.
-        padding = [0] * (max_seq_length - len(input_ids))
-        input_ids += padding
-        input_mask += padding
-        segment_ids += padding
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        label_id = label_map[example.label]
-        if ex_index < 5:
+        if ex_index < num_logged:
+            label_id = features.label_id[ex_index]
             logger.info("*** Example ***")
             logger.info("guid: %s" % (example.guid))
             logger.info("tokens: %s" % " ".join(
                 [str(x) for x in tokens]))
-            logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-            logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
+            logger.info("input_ids: %s" % " ".join([str(x) for x in features.input_ids[ex_index]]))
+            logger.info("input_mask: %s" % " ".join([str(int(x)) for x in features.input_mask[ex_index]]))
             logger.info(
-                "segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
+                "segment_ids: %s" % " ".join([str(x) for x in features.segment_ids[ex_index]]))
             logger.info("label: %s (id = %d)" % (example.label, label_id))
 
-        features.append(
-            InputFeatures(input_ids=input_ids,
-                          input_mask=input_mask,
-                          segment_ids=segment_ids,
-                          label_id=label_id))
+    return features
+
+
+def _convert_examples_to_features_fast(examples, label_ids, max_seq_length, tokenizer, num_logged=5):
+    """Same as `convert_examples_to_features` for single sequences, but tokenizes
+    all examples in one call to a fast (Rust) tokenizer."""
+
+    # the Rust backend adds [CLS]/[SEP], truncates to max_seq_length and pads
+    # exactly like the per-example loop does; encode_batch spreads the texts
+    # over its own thread pool
+    backend = tokenizer.backend_tokenizer
+    truncation, padding = backend.truncation, backend.padding
+    backend.enable_truncation(max_length=max_seq_length)
+    backend.enable_padding(length=max_seq_length, pad_id=tokenizer.pad_token_id,
+                           pad_token=tokenizer.pad_token)
+    try:
+        encodings = backend.encode_batch([example.text_a for example in examples])
+    finally:
+        # leave the tokenizer as it was for any later __call__
+        if truncation is None:
+            backend.no_truncation()
+        else:
+            backend.enable_truncation(**truncation)
+        if padding is None:
+            backend.no_padding()
+        else:
+            backend.enable_padding(**padding)
+    features = InputFeatures(input_ids=np.array([e.ids for e in encodings], dtype=np.int32),
+                             input_mask=np.array([e.attention_mask for e in encodings], dtype=bool),
+                             segment_ids=np.array([e.type_ids for e in encodings], dtype=np.int8),
+                             label_id=label_ids)
+
+    for (ex_index, example) in enumerate(examples[:num_logged]):
+        input_ids = features.input_ids[ex_index].tolist()
+        input_mask = features.input_mask[ex_index].astype(np.int64).tolist()
+        segment_ids = features.segment_ids[ex_index].tolist()
+        label_id = features.label_id[ex_index]
+        logger.info("*** Example ***")
+        logger.info("guid: %s" % (example.guid))
+        logger.info("tokens: %s" % " ".join(
+            [str(x) for x in tokenizer.convert_ids_to_tokens(input_ids[:sum(input_mask)])]))
+        logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
+        logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
+        logger.info(
+            "segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
+        logger.info("label: %s (id = %d)" % (example.label, label_id))
+
+    return features
+
+
+def tokenizer_hash(tokenizer):
+    """Fingerprint of a tokenizer's vocab, casing and kind (fast or slow), used to
+    key feature caches."""
+    vocab = tokenizer.get_vocab() if hasattr(tokenizer, 'get_vocab') else tokenizer.vocab
+    do_lower_case = getattr(tokenizer, 'do_lower_case', None)
+    if do_lower_case is None:
+        do_lower_case = tokenizer.basic_tokenizer.do_lower_case
+    # the fast and slow paths need not produce identical features, so their
+    # caches are kept apart
+    is_fast = getattr(tokenizer, 'is_fast', False)
+    sha = hashlib.sha1(str((do_lower_case, is_fast)).encode('utf-8'))
+    for token in sorted(vocab, key=vocab.get):
+        sha.update(token.encode('utf-8'))
+        sha.update(b'\n')
+    return sha.hexdigest()[:16]
+
+
+def cached_convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, cache_dir,
+                                        overwrite_cache=False, num_workers=1):
+    """`convert_examples_to_features`, memoized on disk as one .npy file per column.
+
+    Cached columns are memory-mapped copy-on-write, so reloading them costs no
+    tokenization and leaves the pages to the OS page cache.
+    """
+    names = ('input_ids', 'input_mask', 'segment_ids', 'label_id')
+    paths = [os.path.join(cache_dir, name + '.npy') for name in names]
+    if not overwrite_cache and all(os.path.isfile(path) for path in paths):
+        logger.info("Loading features from cache %s", cache_dir)
+        return InputFeatures(*[np.load(path, mmap_mode='c') for path in paths])
+
+    features = convert_examples_to_features(examples, label_list, max_seq_length, tokenizer, num_workers)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for name, path in zip(names, paths):
+            # write then rename, so a concurrent run never sees a partial file
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, getattr(features, name))
+            os.replace(tmp_path, path)
+    except OSError as e:
+        # e.g. a read-only data_dir; the features are still good, just not cached
+        logger.warning("Could not write feature cache %s: %s", cache_dir, e)
+        return features
+    logger.info("Saved features to cache %s", cache_dir)
     return features
 
 
@@ -356,14 +542,27 @@ def _truncate_seq_pair(tokens_a, tokens_b, max_length):
     # one token at a time. This makes more sense than truncating an equal percent
     # of tokens from each, since if one sequence is very short then each token
     # that's truncated likely contains more information than a longer sequence.
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_length:
-            break
-        if len(tokens_a) > len(tokens_b):
-            tokens_a.pop()
+    # The final lengths follow directly from the lengths: the longer sequence is
+    # cut down towards the shorter one, and once they are equal the remaining
+    # excess is split with the extra token taken from tokens_b (on a tie the
+    # one-at-a-time loop pops tokens_b first).
+    len_a, len_b = len(tokens_a), len(tokens_b)
+    excess = len_a + len_b - max_length
+    if excess <= 0:
+        return
+    diff = abs(len_a - len_b)
+    if excess <= diff:
+        if len_a > len_b:
+            len_a -= excess
         else:
-            tokens_b.pop()
+            len_b -= excess
+    else:
+        rest = excess - diff
+        len_a = len_b = min(len_a, len_b)
+        len_a -= rest // 2
+        len_b -= (rest + 1) // 2
+    del tokens_a[max(len_a, 0):]
+    del tokens_b[max(len_b, 0):]
 
 
 def accuracy(out, labels):
@@ -384,133 +583,366 @@ def warmup_linear(x, warmup=0.002):
 
 
 
-def sort(train_examples, eval_examples, label_list, id2conf, num_k):
-    label2id = {}
-    id2train = []
-    ud_train_examples, ud_unlabel_examples = train_examples, eval_examples
-    for i, item in enumerate(id2conf):
-        if item[0] not in label2id.keys():
-            label2id[item[0]] = {}
-        label2id[item[0]][i] = item[1]
+def dataloader_kwargs(args):
+    """DataLoader options shared by training and evaluation.
 
-    for i in range(len(label_list)):
-        if i not in label2id.keys():
-            print("no class " + str(i))
-            continue
-        i2cs = label2id[i]
+    Batches are collated into pinned memory so the copies to the GPU can be
+    issued with `non_blocking=True` and overlap with compute.
+    """
+    kwargs = {'pin_memory': args.n_gpu > 0, 'num_workers': args.num_workers}
+    if args.num_workers > 0:
+        kwargs['persistent_workers'] = True
+        kwargs['prefetch_factor'] = 2
+        kwargs['worker_init_fn'] = functools.partial(_seed_worker, args.seed)
+    return kwargs
 
-        sorted_i2cs = sorted(i2cs.items(), reverse=True, key=lambda kv: kv[1])
 
-        for i2c in sorted_i2cs[:num_k]:
-            id2train.append(i2c[0])
-            ex = eval_examples[i2c[0]]
-            ex.label_id = i
-            ud_train_examples.append(ex)
+def length_buckets(max_seq_length):
+    """Lengths that bucketed batches are padded to: powers of two from 16 up
+    to `max_seq_length`, and `max_seq_length` itself."""
+    buckets = []
+    length = 16
+    while length < max_seq_length:
+        buckets.append(length)
+        length *= 2
+    buckets.append(max_seq_length)
+    return np.array(buckets)
 
-    for index in sorted(id2train, reverse=True):
-        del ud_unlabel_examples[index]
 
-    return ud_train_examples, ud_unlabel_examples
+class TrimmedFeatures(Dataset):
+    """Batch-level view of an `InputFeatures` for length-bucketed loading.
+
+    Indexing with an array of indices returns the whole batch, cut down to the
+    bucket length of its longest example, along with the indices themselves.
+    """
+
+    def __init__(self, features, buckets):
+        self.features = features
+        self.buckets = buckets
+        # smallest bucket that holds each example's real tokens
+        self.bucket_ids = np.searchsorted(buckets, features.input_mask.sum(axis=1))
+
+    def __len__(self):
+        return len(self.features)
 
+    def __getitem__(self, index):
+        length = self.buckets[self.bucket_ids[index].max()]
+        return (torch.from_numpy(self.features.input_ids[index, :length]),
+                torch.from_numpy(self.features.input_mask[index, :length]),
+                torch.from_numpy(self.features.segment_ids[index, :length]),
+                torch.from_numpy(self.features.label_id[index]),
+                torch.from_numpy(np.asarray(index, dtype=np.int64)))
 
-def train(model, optimizer, train_examples, eval_examples, best_acc, args):
-    src_train_features = train_examples
+
+class BucketBatchSampler(Sampler):
+    """Yields index arrays of batches that never mix length buckets.
+
+    With a `generator` the examples are shuffled within their bucket and the
+    batches across buckets on every pass; without one the batches keep the
+    dataset order within each bucket.
+    """
+
+    def __init__(self, bucket_ids, batch_size, generator=None):
+        self.bucket_ids = bucket_ids
+        self.batch_size = batch_size
+        self.generator = generator
+
+    def __iter__(self):
+        if self.generator is not None:
+            order = torch.randperm(len(self.bucket_ids), generator=self.generator).numpy()
+        else:
+            order = np.arange(len(self.bucket_ids))
+        order = order[np.argsort(self.bucket_ids[order], kind='stable')]
+        batches = []
+        start = 0
+        for count in np.bincount(self.bucket_ids):
+            for batch_start in range(start, start + count, self.batch_size):
+                batches.append(order[batch_start:min(batch_start + self.batch_size, start + count)])
+            start += count
+        if self.generator is not None:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=self.generator).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        return int(sum(-(-count // self.batch_size) for count in np.bincount(self.bucket_ids)))
+
+
+def make_dataloader(features, batch_size, shuffle, args):
+    """DataLoader over `features` giving (input_ids, input_mask, segment_ids,
+    label_ids, index) batches, `index` being the batch's positions in `features`.
+
+    With --bucket_by_length each batch only holds examples of similar length and
+    is padded to their bucket instead of max_seq_length. Distributed training
+    keeps the plain DistributedSampler.
+    """
+    if args.bucket_by_length and not (shuffle and args.local_rank != -1):
+        dataset = TrimmedFeatures(features, length_buckets(features.input_ids.shape[1]))
+        sampler = BucketBatchSampler(dataset.bucket_ids, batch_size,
+                                     generator=args.generator if shuffle else None)
+        # the sampler yields whole batches, the dataset gathers them in one go
+        return DataLoader(dataset, sampler=sampler, batch_size=None, **dataloader_kwargs(args))
+
+    dataset = TensorDataset(torch.from_numpy(features.input_ids),
+                            torch.from_numpy(features.input_mask),
+                            torch.from_numpy(features.segment_ids),
+                            torch.from_numpy(features.label_id),
+                            torch.arange(len(features)))
+    if not shuffle:
+        return DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=batch_size,
+                          **dataloader_kwargs(args))
+    # shuffling draws from a generator of its own, so it is reproducible from
+    # --seed and independent of anything else that uses the global RNG
+    if args.local_rank == -1:
+        sampler = RandomSampler(dataset, generator=args.generator)
+    else:
+        sampler = DistributedSampler(dataset, seed=args.seed)
+    return DataLoader(dataset, sampler=sampler, batch_size=batch_size, generator=args.generator,
+                      **dataloader_kwargs(args))
+
+
+def prefetch_to_device(dataloader, device):
+    """Yields the batches of a `make_dataloader` loader as (device tensors, index).
+
+    On CUDA the copy of the next batch is issued on a side stream before the
+    current one is handed out, so the host-to-device transfer (from pinned
+    memory) overlaps with the compute on the current batch.
+    """
+    def to_device(batch):
+        # the index stays on the host for scattering results back
+        return tuple(t.to(device, non_blocking=True).long() for t in batch[:4]), batch[4]
+
+    if device.type != 'cuda':
+        for batch in dataloader:
+            yield to_device(batch)
+        return
+
+    stream = torch.cuda.Stream(device)
+    main_stream = torch.cuda.current_stream(device)
+    pending = None
+    for batch in dataloader:
+        with torch.cuda.stream(stream):
+            incoming = to_device(batch)
+        if pending is not None:
+            yield pending
+        main_stream.wait_stream(stream)
+        for t in incoming[0]:
+            # allocated on the side stream, used and freed on the main one
+            t.record_stream(main_stream)
+        pending = incoming
+    if pending is not None:
+        yield pending
+
+
+def _seed_worker(seed, worker_id):
+    # torch already seeds each worker; give python and numpy distinct,
+    # reproducible streams as well (a module-level function so it pickles)
+    random.seed(seed + worker_id)
+    np.random.seed(seed + worker_id)
+
+
+def _select_topk_numpy(labels, confs, num_classes, k):
+    """Indices of the `k` most confident examples of every class, grouped by
+    class and most confident first (earlier index first on ties), plus the
+    number selected per class."""
+    selected = []
+    counts = np.zeros(num_classes, dtype=np.int64)
+    for c in range(num_classes):
+        idxs = np.flatnonzero(labels == c)
+        # O(n) selection of the k most confident, then order only those
+        if len(idxs) > k:
+            if k > 0:
+                kth = -np.partition(-confs[idxs], k - 1)[k - 1]
+                above = confs[idxs] > kth
+                # ties at the cut go to the earliest examples, as a stable sort would
+                ties = np.flatnonzero(confs[idxs] == kth)[:k - above.sum()]
+                above[ties] = True
+                idxs = idxs[above]
+            else:
+                idxs = idxs[:0]
+        selected.append(idxs[np.argsort(-confs[idxs], kind='stable')])
+        counts[c] = len(selected[-1])
+    return np.concatenate(selected) if selected else np.zeros(0, dtype=np.int64), counts
+
+
+def _select_topk_loop(labels, confs, num_classes, k):
+    """Same result as `_select_topk_numpy`, in a single pass that keeps a
+    sorted table of the best `k` per class; meant to be compiled by numba."""
+    counts = np.zeros(num_classes, dtype=np.int64)
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64), counts
+    top_idx = np.empty((num_classes, k), dtype=np.int64)
+    top_conf = np.empty((num_classes, k), dtype=np.float64)
+    for i in range(len(labels)):
+        c = labels[i]
+        if c < 0 or c >= num_classes:
+            continue
+        conf = confs[i]
+        n = counts[c]
+        if n == k and conf <= top_conf[c, k - 1]:
+            continue
+        pos = n if n < k else k - 1
+        # shift strictly smaller entries down, so equal ones keep index order
+        while pos > 0 and top_conf[c, pos - 1] < conf:
+            top_conf[c, pos] = top_conf[c, pos - 1]
+            top_idx[c, pos] = top_idx[c, pos - 1]
+            pos -= 1
+        top_conf[c, pos] = conf
+        top_idx[c, pos] = i
+        if n < k:
+            counts[c] = n + 1
+    selected = np.empty(counts.sum(), dtype=np.int64)
+    offset = 0
+    for c in range(num_classes):
+        selected[offset:offset + counts[c]] = top_idx[c, :counts[c]]
+        offset += counts[c]
+    return selected, counts
+
+
+if njit is not None:
+    select_topk = njit(cache=True)(_select_topk_loop)
+else:
+    select_topk = _select_topk_numpy
+
+
+def sort(label_list, soft_labels, confs, num_k):
+    """Picks the `num_k` most confident unlabelled examples of every class.
+
+    Returns the indices of the picked examples, their pseudo labels and the
+    indices of the examples that stay unlabelled.
+    """
+    soft_labels = np.asarray(soft_labels, dtype=np.int64)
+    confs = np.asarray(confs)
+
+    id2train, counts = select_topk(soft_labels, confs, len(label_list), num_k)
+    for i in np.flatnonzero(counts == 0):
+        print("no class " + str(i))
+    new_labels = np.repeat(np.arange(len(label_list), dtype=np.int64), counts)
+
+    keep = np.ones(len(soft_labels), dtype=bool)
+    keep[id2train] = False
+
+    return id2train, new_labels, np.flatnonzero(keep)
+
+
+def unwrap_model(model):
+    """The model under any torch.compile and DDP wrappers."""
+    model = getattr(model, '_orig_mod', model)
+    return model.module if hasattr(model, 'module') else model
+
+
+def clip_grad_norm_per_tensor_(parameters, max_norm):
+    """Clips every gradient to `max_norm` separately, as BertAdam does, with
+    multi-tensor kernels and without a host sync."""
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if not grads:
+        return
+    norms = torch.stack(torch._foreach_norm(grads))
+    # same clip coefficient as torch.nn.utils.clip_grad_norm_, per tensor
+    coefs = (max_norm / (norms + 1e-6)).clamp_(max=1.0)
+    torch._foreach_mul_(grads, list(coefs.unbind()))
+
+
+def train(model, optimizer, scheduler, scaler, train_examples, eval_examples, best_acc, args):
     logger.info("***** Running training *****")
     logger.info("  Num examples = %d", len(train_examples))
     logger.info("  Batch size = %d", args.train_batch_size)
     logger.info("  Num steps = %d", args.num_train_steps)
-    src_input_ids = torch.tensor([f.input_ids for f in src_train_features], dtype=torch.long)
-    src_input_mask = torch.tensor([f.input_mask for f in src_train_features], dtype=torch.long)
-    src_segment_ids = torch.tensor([f.segment_ids for f in src_train_features], dtype=torch.long)
-    src_label_ids = torch.tensor([f.label_id for f in src_train_features], dtype=torch.long)
-    train_data = TensorDataset(src_input_ids, src_input_mask, src_segment_ids, src_label_ids)
+    train_dataloader = make_dataloader(train_examples, args.train_batch_size, True, args)
+    train_sampler = train_dataloader.sampler
 
-    if args.local_rank == -1:
-        train_sampler = RandomSampler(train_data)
-    else:
-        train_sampler = DistributedSampler(train_data)
-    train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+    # the validation set is the same every epoch, so its loader is built once
+    # Run prediction for full data
+    eval_dataloader = make_dataloader(eval_examples, args.eval_batch_size, False, args)
 
     if args.adv_training:
         fgm = FGM(model)
+    # no_sync() lives on the DDP wrapper, which torch.compile may wrap in turn
+    ddp_model = getattr(model, '_orig_mod', model)
     model.train()
-    for _ in trange(int(args.num_train_epochs), desc="Epoch"):
+    for epoch in trange(int(args.num_train_epochs), desc="Epoch"):
+        if isinstance(train_sampler, DistributedSampler):
+            # reshuffle every epoch, identically on all processes
+            train_sampler.set_epoch(epoch)
         tr_loss = 0
         nb_tr_examples, nb_tr_steps = 0, 0
         for step, batch in enumerate(tqdm(train_dataloader, desc="Iteration")):
-            batch = tuple(t.to(args.device) for t in batch)
+            batch = tuple(t.to(args.device, non_blocking=True).long() for t in batch[:4])
             input_ids, input_mask, segment_ids, label_ids = batch
 
-            loss, pool_rep = model(input_ids, segment_ids, input_mask, label_ids)
+            # on accumulation micro-steps DDP only accumulates the grads locally,
+            # they are all-reduced once, on the step that updates the weights
+            sync_step = (step + 1) % args.gradient_accumulation_steps == 0
+            if isinstance(ddp_model, torch.nn.parallel.DistributedDataParallel) and not sync_step:
+                sync_context = ddp_model.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
+            with sync_context:
+                with torch.cuda.amp.autocast(enabled=args.fp16):
+                    loss, pool_rep = model(input_ids, segment_ids, input_mask, label_ids)
 
-            if args.n_gpu > 1:
-                loss = loss.mean()  # mean() to average on multi-gpu.
-            if args.gradient_accumulation_steps > 1:
-                loss = loss / args.gradient_accumulation_steps
+                if args.gradient_accumulation_steps > 1:
+                    loss = loss / args.gradient_accumulation_steps
 
-            if args.fp16:
-                optimizer.backward(loss)
-            else:
-                loss.backward()
+                scaler.scale(loss).backward()
 
-            if args.adv_training:
-                fgm.attack()  
-                loss_adv, _ = model(input_ids, segment_ids, input_mask, label_ids)
-                if args.n_gpu > 1:
-                    loss_adv = loss_adv.mean()
-                loss_adv.backward()  
-                fgm.restore() 
+                if args.adv_training:
+                    # the perturbation is normalized by the grad norm, so the loss
+                    # scale cancels out; FGM masks the step to zero when the
+                    # scaled grads overflowed, and GradScaler skips that step
+                    fgm.attack()  
+                    with torch.cuda.amp.autocast(enabled=args.fp16):
+                        loss_adv, _ = model(input_ids, segment_ids, input_mask, label_ids)
+                    scaler.scale(loss_adv).backward()  
+                    fgm.restore() 
 
 
             tr_loss += loss.item()
             nb_tr_examples += input_ids.size(0)
             nb_tr_steps += 1
-            if (step + 1) % args.gradient_accumulation_steps == 0:
-                # modify learning rate with special warm up BERT uses
-                lr_this_step = args.learning_rate * warmup_linear(args.global_step / args.t_total,
-                                                                  args.warmup_proportion)
-                for param_group in optimizer.param_groups:
-                    param_group['lr'] = lr_this_step
-                optimizer.step()
+            if sync_step:
+                if scheduler is None:
+                    # modify learning rate with special warm up BERT uses
+                    lr_this_step = args.learning_rate * warmup_linear(args.global_step / args.t_total,
+                                                                      args.warmup_proportion)
+                    for param_group in optimizer.param_groups:
+                        param_group['lr'] = lr_this_step
+                else:
+                    # AdamW does not clip, so clip each tensor like BertAdam
+                    # does, on the unscaled grads
+                    scaler.unscale_(optimizer)
+                    clip_grad_norm_per_tensor_(model.parameters(), 1.0)
+                # unscales the grads first and skips the step if they overflowed
+                scaler.step(optimizer)
+                scaler.update()
+                if scheduler is not None:
+                    scheduler.step()
                 optimizer.zero_grad()
                 args.global_step += 1
 
 
         # validation starts
-        eval_s_features = eval_examples
         logger.info("***** Running evaluation *****")
         logger.info("  Num examples = %d", len(eval_examples))
         logger.info("  Batch size = %d", args.eval_batch_size)
-        src_input_ids = torch.tensor([f.input_ids for f in eval_s_features], dtype=torch.long)
-        src_input_mask = torch.tensor([f.input_mask for f in eval_s_features], dtype=torch.long)
-        src_segment_ids = torch.tensor([f.segment_ids for f in eval_s_features], dtype=torch.long)
-        src_label_ids = torch.tensor([f.label_id for f in eval_s_features], dtype=torch.long)
-        eval_data = TensorDataset(src_input_ids, src_input_mask, src_segment_ids, src_label_ids)
-        # Run prediction for full data
-        eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
 
         model.eval()
         eval_loss, eval_accuracy = 0, 0
         nb_eval_steps, nb_eval_examples = 0, 0
         pred_l, true_l = [], []
-        reps = []
-        labels = []
 
         for batch in eval_dataloader:
-            batch = tuple(t.to(args.device) for t in batch)
+            batch = tuple(t.to(args.device, non_blocking=True).long() for t in batch[:4])
             src_input_ids, src_input_mask, src_segment_ids, src_label_ids = batch
 
-            with torch.no_grad():
-                tmp_eval_loss, pooled_ouput = model(src_input_ids, src_segment_ids, src_input_mask, src_label_ids)
+            with torch.inference_mode():
+                # one forward for both the logits and the loss
                 logits, pooled_ouput = model(src_input_ids, src_segment_ids, src_input_mask)
+                tmp_eval_loss = torch.nn.functional.cross_entropy(logits, src_label_ids)
 
-            reps.append(pooled_ouput.cpu().detach().numpy())
             logits = logits.detach().cpu().numpy()
             label_ids = src_label_ids.to('cpu').numpy()
             tmp_eval_accuracy = accuracy(logits, label_ids)
-            labels.append(label_ids)
-            eval_loss += tmp_eval_loss.mean().item()
+            eval_loss += tmp_eval_loss.item()
             eval_accuracy += tmp_eval_accuracy
 
             nb_eval_examples += src_input_ids.size(0)
@@ -529,89 +961,131 @@ def train(model, optimizer, train_examples, eval_examples, best_acc, args):
         if eval_accuracy > best_acc:
             best_acc = eval_accuracy
             # Save a trained model
-            model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model it-self
+            model_to_save = unwrap_model(model)  # Only save the model it-self
             # output_model_file = os.path.join(args.output_dir, "pytorch_model.bin")
-            torch.save(model_to_save.state_dict(), args.output_model_file)
+            # every process holds the same weights, one copy on disk is enough
+            if is_main_process(args):
+                torch.save(model_to_save.state_dict(), args.output_model_file)
         model.train()
     return best_acc
 
+def _feature_chunks(eval_examples, label_list, args):
+    """(offset, features) pieces of `eval_examples`: the `InputFeatures` itself,
+    or a list of `InputExample`s tokenized --unlabel_chunk_size at a time.
+
+    Chunks are tokenized in this process: a worker pool per chunk would be
+    forked from the CUDA-initialised process in the middle of inference.
+    """
+    if isinstance(eval_examples, InputFeatures):
+        yield 0, eval_examples
+        return
+    for start in range(0, len(eval_examples), args.unlabel_chunk_size):
+        # only the first chunk logs its leading examples
+        yield start, convert_examples_to_features(eval_examples[start:start + args.unlabel_chunk_size],
+                                                  label_list, args.max_seq_length, args.tokenizer,
+                                                  num_logged=5 if start == 0 else 0)
+
+
 def eval(model, train_example, eval_examples, label_list, args):
+    """Evaluates `model` on `eval_examples` and, when self-training, moves the
+    most confident of them into the training set with their predicted labels.
+
+    `eval_examples` is an `InputFeatures`, or a list of `InputExample`s that is
+    featurized in chunks as it is scored (--stream_unlabel); the unlabelled
+    set returned is of the same kind.
+    """
 
-    eval_s_features = eval_examples
     logger.info("***** Running evaluation *****")
     logger.info("  Num examples = %d", len(eval_examples))
     logger.info("  Batch size = %d", args.eval_batch_size)
-    src_input_ids = torch.tensor([f.input_ids for f in eval_s_features], dtype=torch.long)
-    src_input_mask = torch.tensor([f.input_mask for f in eval_s_features], dtype=torch.long)
-    src_segment_ids = torch.tensor([f.segment_ids for f in eval_s_features], dtype=torch.long)
-    src_label_ids = torch.tensor([f.label_id for f in eval_s_features], dtype=torch.long)
-    eval_data = TensorDataset(src_input_ids, src_input_mask, src_segment_ids, src_label_ids)
-    # Run prediction for full data
-    eval_sampler = SequentialSampler(eval_data)
-    eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
 
     model.eval()
-    eval_loss, eval_accuracy = 0, 0
-    nb_eval_steps, nb_eval_examples = 0, 0
-    pred_l, true_l = [], []
-    reps = []
-    labels = []
-    cons_r = 0
-    # variable for self-training:
-    id2maxp = []
-
-    for batch in eval_dataloader:
-        batch = tuple(t.to(args.device) for t in batch)
-        src_input_ids, src_input_mask, src_segment_ids, src_label_ids = batch
-
-        with torch.no_grad():
-            tmp_eval_loss, pooled_ouput = model(src_input_ids, src_segment_ids, src_input_mask, src_label_ids)
-            logits, pooled_ouput = model(src_input_ids, src_segment_ids, src_input_mask)
-
-        reps.append(pooled_ouput.cpu().detach().numpy())
-        logits = torch.nn.functional.softmax(logits)
-        logits = logits.detach().cpu().numpy()
-        label_ids = src_label_ids.to('cpu').numpy()
-        tmp_eval_accuracy = accuracy(logits, label_ids)
-        labels.append(label_ids)
-        eval_loss += tmp_eval_loss.mean().item()
-        eval_accuracy += tmp_eval_accuracy
-
-        nb_eval_examples += src_input_ids.size(0)
-        nb_eval_steps += 1
-        pred_labels = np.argmax(logits, axis=1)
-        pred_l.append(pred_labels)
-        true_l.append(label_ids)
-
-        soft_label = np.argmax(logits, axis=1)
-        confi = np.max(logits, axis=1)
-        for i in range(len(soft_label)):
-            id2maxp.append((soft_label[i], confi[i]))
+    eval_model = model
+    if args.compile and hasattr(torch, 'compile'):
+        # padded to max_seq_length, batches come in two shapes (full and the
+        # last one), so specialize on each; --bucket_by_length gives a full and
+        # a partial batch per bucket, more than dynamo's recompile limit, so
+        # there the shapes are left to its automatic dynamic-shape detection
+        eval_model = torch.compile(model, mode='reduce-overhead',
+                                   dynamic=None if args.bucket_by_length else False)
+    eval_loss = 0
+    # predicted class of every example and its probability (the soft labels
+    # and confidences for self-training), scattered back by example index as
+    # batches may come in any order
+    pred_l = np.empty(len(eval_examples), dtype=np.int64)
+    conf_l = np.empty(len(eval_examples), dtype=np.float32)
+    true_l = np.empty(len(eval_examples), dtype=np.int64)
+
+    for offset, eval_s_features in _feature_chunks(eval_examples, label_list, args):
+        true_l[offset:offset + len(eval_s_features)] = eval_s_features.label_id
+        # Run prediction for full data
+        eval_dataloader = make_dataloader(eval_s_features, args.eval_batch_size, False, args)
+        for batch, index in prefetch_to_device(eval_dataloader, args.device):
+            src_input_ids, src_input_mask, src_segment_ids, src_label_ids = batch
+
+            with torch.inference_mode():
+                # one forward for both the logits and the loss
+                logits, pooled_ouput = eval_model(src_input_ids, src_segment_ids, src_input_mask)
+                tmp_eval_loss = torch.nn.functional.cross_entropy(logits, src_label_ids)
+
+            # reduce on the device and only copy back the label and its probability
+            confi, soft_label = torch.softmax(logits, dim=1).max(dim=1)
+            index = index.numpy() + offset
+            pred_l[index] = soft_label.cpu().numpy()
+            conf_l[index] = confi.float().cpu().numpy()
+            # every chunk ends in a partial batch, so weight by batch size to
+            # keep the loss independent of the chunking
+            eval_loss += tmp_eval_loss.item() * len(index)
 
     if args.self_train:
-        ud_train_examples, ud_unlabel_examples = sort(train_example, eval_examples, label_list, id2maxp, args.num_k)
+        id2train, new_labels, id2keep = sort(label_list, pred_l, conf_l, args.num_k)
+        # a round is only index selection on the feature arrays
+        if isinstance(eval_examples, InputFeatures):
+            selected = eval_examples[id2train]
+            ud_unlabel_examples = eval_examples[id2keep]
+        else:
+            # only the few picked examples are tokenized again
+            selected = convert_examples_to_features([eval_examples[i] for i in id2train], label_list,
+                                                    args.max_seq_length, args.tokenizer, num_logged=0)
+            ud_unlabel_examples = [eval_examples[i] for i in id2keep]
+        selected.label_id = new_labels
+        ud_train_examples = InputFeatures.concat([train_example, selected])
     else:
         ud_train_examples, ud_unlabel_examples = train_example, eval_examples
-    pred_l = np.concatenate(pred_l, axis=None)
-    true_l = np.concatenate(true_l, axis=None)
     f1 = f1_score(true_l, pred_l, average='micro')
-    eval_loss = eval_loss / nb_eval_steps
-    eval_accuracy = eval_accuracy / nb_eval_examples
+    eval_loss = eval_loss / len(pred_l)
+    eval_accuracy = np.sum(pred_l == true_l) / len(pred_l)
 
     result = {'eval_loss': eval_loss,
               'eval_accuracy': eval_accuracy,
               'global_step': args.global_step,
               'loss': args.tr_loss / args.nb_tr_steps,
               'f1': f1}
-    output_eval_file = os.path.join(args.output_dir, "eval_results.txt")
-    with open(output_eval_file, "w") as writer:
-        logger.info("***** Eval results *****")
-        for key in sorted(result.keys()):
-            logger.info("  %s = %s", key, str(result[key]))
-            writer.write("%s = %s\n" % (key, str(result[key])))
+    if is_main_process(args):
+        output_eval_file = os.path.join(args.output_dir, "eval_results.txt")
+        with open(output_eval_file, "w") as writer:
+            logger.info("***** Eval results *****")
+            for key in sorted(result.keys()):
+                logger.info("  %s = %s", key, str(result[key]))
+                writer.write("%s = %s\n" % (key, str(result[key])))
     return ud_train_examples, ud_unlabel_examples
 
 
+def load_checkpoint(path):
+    """Loads a state dict saved by `train`, memory-mapped on the CPU.
+
+    Tensors are paged in from the file as the model copies them, instead of
+    being read into memory and unpickled up front; `weights_only` refuses
+    anything but tensors and plain containers.
+    """
+    return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+
+
+def is_main_process(args):
+    """Whether this process writes checkpoints and results (rank 0, or not distributed)."""
+    return args.local_rank == -1 or torch.distributed.get_rank() == 0
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -636,6 +1110,16 @@ def main():
                         help="The output directory where the model predictions and checkpoints will be written.")
 
     ## Other parameters
+    parser.add_argument("--output_root",
+                        default=os.environ.get('BERT_OUTPUT_ROOT', ''),
+                        type=str,
+                        help="Directory that relative --output_dir and --old_output_dir are resolved against "
+                             "(default: $BERT_OUTPUT_ROOT). Outputs go to a seed<seed> subdirectory of output_dir.")
+    parser.add_argument("--old_output_dir",
+                        default=None,
+                        type=str,
+                        help="--output_dir of the run to resume from, with --resume; its checkpoint is "
+                             "read from the seed<seed> subdirectory, like the outputs are written.")
     parser.add_argument("--max_seq_length",
                         default=128,
                         type=int,
@@ -653,7 +1137,8 @@ def main():
     parser.add_argument("--resume",
                         default=False,
                         action='store_true',
-                        help="Whether to resume training.")
+                        help="Whether to resume training: with --do_train, start from the checkpoint in "
+                             "--old_output_dir instead of the pretrained weights.")
     parser.add_argument("--do_lower_case",
                         default=False,
                         action='store_true',
@@ -665,11 +1150,12 @@ def main():
     parser.add_argument("--train_batch_size",
                         default=32,
                         type=int,
-                        help="Total batch size for training.")
+                        help="Batch size for training, per process: under torchrun the total is "
+                             "nproc_per_node times this.")
     parser.add_argument("--eval_batch_size",
                         default=512,
                         type=int,
-                        help="Total batch size for eval.")
+                        help="Batch size for eval, per process under torchrun.")
     parser.add_argument("--num_k",
                         default=40,
                         type=int,
@@ -701,12 +1187,16 @@ def main():
                         help="Whether not to use CUDA when available")
     parser.add_argument("--local_rank",
                         type=int,
-                        default=-1,
-                        help="local_rank for distributed training on gpus")
+                        default=int(os.environ.get('LOCAL_RANK', -1)),
+                        help="local_rank for distributed training on gpus (set by torchrun)")
     parser.add_argument('--seed',
                         type=int,
                         default=42,
                         help="random seed for initialization")
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=0,
+                        help="Number of DataLoader worker processes.")
     parser.add_argument('--gradient_accumulation_steps',
                         type=int,
                         default=1,
@@ -714,12 +1204,53 @@ def main():
     parser.add_argument('--fp16',
                         default=False,
                         action='store_true',
-                        help="Whether to use 16-bit float precision instead of 32-bit")
+                        help="Whether to use mixed precision (autocast + loss scaling) instead of 32-bit")
+    parser.add_argument('--compile',
+                        default=False,
+                        action='store_true',
+                        help="Whether to run training and evaluation through torch.compile (PyTorch 2.0+).")
+    parser.add_argument('--num_tokenize_workers',
+                        type=int,
+                        # torchrun starts LOCAL_WORLD_SIZE ranks per node that all
+                        # featurize at once, so they share the cores
+                        default=max(1, (os.cpu_count() or 1) // int(os.environ.get('LOCAL_WORLD_SIZE', 1))),
+                        help="Processes used to tokenize with the slow BertTokenizer (the fast one is "
+                             "already multi-threaded); by default the cores are split between the "
+                             "processes on a node.")
+    parser.add_argument('--bucket_by_length',
+                        default=False,
+                        action='store_true',
+                        help="Batch examples of similar length together and pad each batch only to its "
+                             "length bucket instead of max_seq_length.")
+    parser.add_argument('--stream_unlabel',
+                        default=False,
+                        action='store_true',
+                        help="Keep the unlabelled pool as raw examples and tokenize it in chunks while "
+                             "pseudo-labelling, instead of holding all of its features in memory.")
+    parser.add_argument('--unlabel_chunk_size',
+                        type=int,
+                        default=8192,
+                        help="Examples tokenized at a time with --stream_unlabel (in the main process, "
+                             "without --num_tokenize_workers).")
+    parser.add_argument('--legacy_optimizer',
+                        default=False,
+                        action='store_true',
+                        help="Train with the original BertAdam instead of fused AdamW with a warmup schedule.")
+    parser.add_argument('--keep_optimizer_state',
+                        default=False,
+                        action='store_true',
+                        help="Keep training the same weights, optimizer state and one learning rate schedule "
+                             "across self-training rounds instead of restarting from the pretrained model with a "
+                             "new optimizer each round.")
+    parser.add_argument('--overwrite_cache',
+                        default=False,
+                        action='store_true',
+                        help="Re-tokenize the data even if cached features exist in data_dir.")
     parser.add_argument('--loss_scale',
                         type=float, default=0,
                         help="Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.\n"
-                             "0 (default value): dynamic loss scaling.\n"
-                             "Positive power of 2: static loss scaling value.\n")
+                             "0 (default value): dynamic loss scaling from the GradScaler default.\n"
+                             "Positive power of 2: initial loss scale, still lowered on overflow.\n")
 
     args = parser.parse_args()
 
@@ -736,7 +1267,13 @@ def main():
 
     if args.local_rank == -1 or args.no_cuda:
         device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
-        n_gpu = torch.cuda.device_count()
+        # a single process drives one device; several GPUs are used through
+        # one process each (torchrun), never through DataParallel
+        n_gpu = 1 if device.type == 'cuda' else 0
+        if n_gpu and torch.cuda.device_count() > 1:
+            logger.warning("%d GPUs visible but only one is used; launch with "
+                           "torchrun --nproc_per_node=N for multi-GPU training.",
+                           torch.cuda.device_count())
     else:
         torch.cuda.set_device(args.local_rank)
         device = torch.device("cuda", args.local_rank)
@@ -757,23 +1294,44 @@ def main():
     torch.manual_seed(args.seed)
     if n_gpu > 0:
         torch.cuda.manual_seed_all(args.seed)
+    # inputs have a few fixed shapes, so let cuDNN pick its fastest kernels
+    # once, and run fp32 matmuls on TF32 tensor cores (Ampere and later)
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+    # drives the training sampler and the DataLoader worker seeds
+    args.generator = torch.Generator()
+    args.generator.manual_seed(args.seed)
 
     if not args.do_train and not args.do_eval:
         raise ValueError("At least one of `do_train` or `do_eval` must be True.")
 
-    args.output_dir = '/freespace/local/xd48/bert_output/' + args.output_dir
-    if os.path.exists(args.output_dir) and os.listdir(args.output_dir):
+    # one directory per seed, so parallel jobs never share a checkpoint
+    args.output_dir = os.path.join(args.output_root, args.output_dir, "seed{}".format(args.seed))
+    if os.path.isfile(os.path.join(args.output_dir, "pytorch_model.bin")):
         # raise ValueError("Output directory ({}) already exists and is not empty.".format(args.output_dir))
         print("load model from directory ({})".format(args.output_dir))
     else:
-        os.makedirs(args.output_dir, exist_ok=True)
+        try:
+            os.makedirs(args.output_dir)
+        except FileExistsError:
+            # created by another rank or job in the meantime
+            pass
 
     task_name = args.task_name.lower()
 
     if task_name not in processors:
         raise ValueError("Task not found: %s" % (task_name))
 
-    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    tokenizer = None
+    if BertTokenizerFast is not None:
+        try:
+            tokenizer = BertTokenizerFast.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+        except (OSError, ValueError):
+            logger.info("No fast tokenizer found for %s, falling back to BertTokenizer", args.bert_model)
+    if tokenizer is None:
+        tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
 
     processor = processors[task_name](args.lang, tokenizer)
     num_labels = num_labels_task[task_name]
@@ -791,13 +1349,14 @@ def main():
             len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps * args.num_train_epochs)
 
     # Prepare model
-    if args.resume:
+    resume_state = None
+    if args.resume and args.do_train:
         print('Resume Training')
-        args.old_output_dir = '/freespace/local/xd48/bert_output/' + args.old_output_dir
-        saved_output_model_file = os.path.join(args.old_output_dir, "pytorch_model.bin")
-        model_state_dict = torch.load(saved_output_model_file)
-        model = BertForSequenceClassification.from_pretrained(args.bert_model, state_dict=model_state_dict,
-                                                              num_labels=num_labels)
+        if args.old_output_dir is None:
+            raise ValueError("--resume needs --old_output_dir.")
+        # the previous run wrote its checkpoint under the same per-seed layout
+        args.old_output_dir = os.path.join(args.output_root, args.old_output_dir, "seed{}".format(args.seed))
+        resume_state = load_checkpoint(os.path.join(args.old_output_dir, "pytorch_model.bin"))
 
 
     args.output_model_file = os.path.join(args.output_dir, "pytorch_model.bin")
@@ -810,98 +1369,177 @@ def main():
     eval_examples = processor.get_dev_examples(args.data_dir)
     unlabel_examples = processor.get_unlabel_examples(args.data_dir)
 
+    # cached features are only valid for the same model, casing, vocab, task
+    # (its label order gives the label ids) and data files; editing any file
+    # in data_dir invalidates them
+    data_mtime = max([os.path.getmtime(os.path.join(args.data_dir, name))
+                      for name in os.listdir(args.data_dir)
+                      if not name.startswith('.') and os.path.isfile(os.path.join(args.data_dir, name))] or [0])
+    # the last entry versions the column dtypes
+    cache_key = hashlib.sha1(repr((args.bert_model, args.do_lower_case, tokenizer_hash(tokenizer),
+                                   task_name, tuple(label_list),
+                                   data_mtime, 'int32/bool/int8')).encode('utf-8')).hexdigest()[:16]
+
+    def feature_cache_dir(split):
+        return os.path.join(args.data_dir, ".cache_{}_{}_{}_{}".format(
+            split, args.lang, args.max_seq_length, cache_key))
+
     if args.do_train:
-        src_train_features = convert_examples_to_features(
-            train_examples, label_list, args.max_seq_length, tokenizer)
+        src_train_features = cached_convert_examples_to_features(
+            train_examples, label_list, args.max_seq_length, tokenizer,
+            feature_cache_dir('train'), args.overwrite_cache, args.num_tokenize_workers)
     else:
         src_train_features = None
 
-    ul_s_features = convert_examples_to_features(
-        unlabel_examples[0], label_list, args.max_seq_length, tokenizer)
+    if args.stream_unlabel:
+        # featurized chunk by chunk while it is scored in eval()
+        args.tokenizer = tokenizer
+        ul_s_features = unlabel_examples[0]
+    else:
+        ul_s_features = cached_convert_examples_to_features(
+            unlabel_examples[0], label_list, args.max_seq_length, tokenizer,
+            feature_cache_dir('unlabel'), args.overwrite_cache, args.num_tokenize_workers)
 
     ud_train_fea, ud_unlabel_fea = src_train_features, ul_s_features
 
-    eval_features = convert_examples_to_features(
-        eval_examples, label_list, args.max_seq_length, tokenizer)
+    eval_features = cached_convert_examples_to_features(
+        eval_examples, label_list, args.max_seq_length, tokenizer,
+        feature_cache_dir('dev'), args.overwrite_cache, args.num_tokenize_workers)
 
     best_acc = 0
 
+    # loss scaling for mixed precision, a no-op unless --fp16 is set; one
+    # scaler for all rounds, so later rounds start from an already tuned scale
+    scaler_kwargs = {'init_scale': args.loss_scale} if args.loss_scale > 0 else {}
+    scaler = torch.cuda.amp.GradScaler(enabled=args.fp16, **scaler_kwargs)
+
     if args.do_train:
+        # the checkpoint is parsed once; every round restarts from a CPU copy of
+        # the pretrained (or, with --resume, the resumed) weights in the same
+        # model (and wrapper)
+        model = BertForSequenceClassification.from_pretrained(args.bert_model, state_dict=resume_state,
+                                                                cache_dir=PYTORCH_PRETRAINED_BERT_CACHE / 'distributed_{}'.format(
+                                                                args.local_rank), num_labels=num_labels)
+        del resume_state
+        pretrained_state = {name: tensor.clone() for name, tensor in model.state_dict().items()}
+        if is_main_process(args):
+            # lets an eval-only run rebuild the model without the pretrained weights
+            with open(os.path.join(args.output_dir, CONFIG_NAME), 'w', encoding='utf-8') as writer:
+                writer.write(model.config.to_json_string())
+        model.to(device)
+        base_model = model
+        if args.local_rank != -1:
+            # one process per GPU; gradients are all-reduced in buckets
+            # while the backward is still running
+            model = torch.nn.parallel.DistributedDataParallel(model,
+                                                              device_ids=[args.local_rank],
+                                                              output_device=args.local_rank,
+                                                              bucket_cap_mb=25)
+        train_model = model
+        if args.compile and hasattr(torch, 'compile'):
+            # inputs padded to max_seq_length have static shapes; length
+            # buckets do not (see eval()), so they are compiled dynamic. The
+            # default mode, since CUDA graph outputs would be overwritten by
+            # the adversarial forward before the first loss is read
+            train_model = torch.compile(model, dynamic=None if args.bucket_by_length else False)
+
+        # the parameters are the same in every round, so split them once
+        no_decay = ('bias', 'LayerNorm.bias', 'LayerNorm.weight')
+        decay_params, no_decay_params = [], []
+        for n, p in model.named_parameters():
+            (no_decay_params if any(nd in n for nd in no_decay) else decay_params).append(p)
+
         for time in range(self_train_time):
             args.tr_loss = 0
             args.nb_tr_steps = 1
-            args.global_step = 0
-            model = BertForSequenceClassification.from_pretrained(args.bert_model,
-                                                                    cache_dir=PYTORCH_PRETRAINED_BERT_CACHE / 'distributed_{}'.format(
-                                                                    args.local_rank), num_labels=num_labels)
-
-            if args.fp16:
-                model.half()
-            model.to(device)
-            if args.local_rank != -1:
-                try:
-                    from apex.parallel import DistributedDataParallel as DDP
-                except ImportError:
-                    raise ImportError(
-                        "Please install apex from https://www.github.com/nvidia/apex to use distributed and fp16 training.")
-
-                model = DDP(model)
-            elif n_gpu > 1:
-                model = torch.nn.DataParallel(model)
-
-            # Prepare optimizer
-            param_optimizer = list(model.named_parameters())
-            no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
-            optimizer_grouped_parameters = [
-                {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)],
-                 'weight_decay': 0.01},
-                {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
-            ]
-            t_total = num_train_steps
-            if args.local_rank != -1:
-                t_total = t_total // torch.distributed.get_world_size()
-            if args.fp16:
-                try:
-                    from apex.optimizers import FP16_Optimizer
-                    from apex.optimizers import FusedAdam
-                except ImportError:
-                    raise ImportError(
-                        "Please install apex from https://www.github.com/nvidia/apex to use distributed and fp16 training.")
-
-                optimizer = FusedAdam(optimizer_grouped_parameters,
-                                      lr=args.learning_rate,
-                                      bias_correction=False,
-                                      max_grad_norm=1.0)
-                if args.loss_scale == 0:
-                    optimizer = FP16_Optimizer(optimizer, dynamic_loss_scale=True)
+            # the weights, Adam's moments and the learning rate schedule carry
+            # over from round to round with --keep_optimizer_state; resetting
+            # the weights would leave the moments stale for the new classifier
+            keep_optimizer = args.keep_optimizer_state and time > 0
+            if not keep_optimizer:
+                args.global_step = 0
+            if time > 0 and not keep_optimizer:
+                base_model.load_state_dict(pretrained_state)
+                # a new random classifier each round, as a fresh from_pretrained
+                # gives
+                base_model.classifier.apply(base_model.init_bert_weights)
+                if args.local_rank != -1:
+                    # DDP only broadcasts the weights when it is built, so hand
+                    # every rank rank 0's draw instead of relying on the RNGs
+                    # still being in step
+                    with torch.no_grad():
+                        for param in base_model.classifier.parameters():
+                            torch.distributed.broadcast(param, src=0)
+
+            if not keep_optimizer:
+                # Prepare optimizer
+                optimizer_grouped_parameters = [
+                    {'params': decay_params, 'weight_decay': 0.01},
+                    {'params': no_decay_params, 'weight_decay': 0.0}
+                ]
+                t_total = num_train_steps
+                if args.local_rank != -1:
+                    t_total = t_total // torch.distributed.get_world_size()
+                if args.keep_optimizer_state:
+                    # one schedule over all rounds
+                    t_total *= self_train_time
+                # fp16 is handled by autocast and the GradScaler in train(), the
+                # weights and the optimizer state stay in fp32
+                if args.legacy_optimizer:
+                    # BertAdam clips the (already unscaled) grads itself, train()
+                    # sets the warmup learning rate on every step
+                    optimizer = BertAdam(optimizer_grouped_parameters,
+                                         lr=args.learning_rate,
+                                         warmup=args.warmup_proportion,
+                                         t_total=t_total)
+                    scheduler = None
                 else:
-                    optimizer = FP16_Optimizer(optimizer, static_loss_scale=args.loss_scale)
-
-            else:
-                optimizer = BertAdam(optimizer_grouped_parameters,
-                                     lr=args.learning_rate,
-                                     warmup=args.warmup_proportion,
-                                     t_total=t_total)
+                    # one multi-tensor kernel updates all parameters on the GPU
+                    optimizer = torch.optim.AdamW(optimizer_grouped_parameters,
+                                                  lr=args.learning_rate,
+                                                  betas=(0.9, 0.999),
+                                                  eps=1e-6,
+                                                  fused=args.device.type == 'cuda')
+                    # linear warmup then linear decay, never below zero once the
+                    # growing self-training set runs past t_total
+                    scheduler = torch.optim.lr_scheduler.LambdaLR(
+                        optimizer, lambda step: max(0.0, warmup_linear(step / t_total, args.warmup_proportion)))
 
             args.t_total = t_total
 
-            best_acc = train(model, optimizer, ud_train_fea, eval_features, best_acc, args)
+            best_acc = train(train_model, optimizer, scheduler, scaler, ud_train_fea, eval_features, best_acc, args)
 
             if args.self_train and time != self_train_time-1:
                 ud_train_fea, ud_unlabel_fea = eval(model, ud_train_fea, ud_unlabel_fea, label_list, args)
 
     args.self_train = False
-    model_state_dict = torch.load(args.output_model_file)
-    model = BertForSequenceClassification.from_pretrained(args.bert_model, state_dict=model_state_dict, num_labels=num_labels)
-    model.to(device)
+    if args.local_rank != -1:
+        # the best checkpoint is written by rank 0 only
+        torch.distributed.barrier()
+    model_state_dict = load_checkpoint(args.output_model_file)
+    config_file = os.path.join(args.output_dir, CONFIG_NAME)
+    if args.do_train:
+        # the trained model is still on the device, copy the best weights into it
+        base_model.load_state_dict(model_state_dict)
+        model = base_model
+    elif os.path.isfile(config_file):
+        # build from the saved config and take the memory-mapped tensors
+        # as they are, without reading the pretrained weights first
+        model = BertForSequenceClassification(BertConfig.from_json_file(config_file), num_labels=num_labels)
+        model.load_state_dict(model_state_dict, assign=True)
+        model.to(device)
+    else:
+        model = BertForSequenceClassification.from_pretrained(args.bert_model, state_dict=model_state_dict, num_labels=num_labels)
+        model.to(device)
 
-    if args.do_eval and (args.local_rank == -1 or torch.distributed.get_rank() == 0):
+    if args.do_eval and is_main_process(args):
         args.tr_loss = 0
         args.nb_tr_steps = 1
         args.global_step = 0
         test_examples = processor.get_test_examples(args.data_dir)
-        test_features = convert_examples_to_features(
-            test_examples, label_list, args.max_seq_length, tokenizer)
+        test_features = cached_convert_examples_to_features(
+            test_examples, label_list, args.max_seq_length, tokenizer,
+            feature_cache_dir('test'), args.overwrite_cache, args.num_tokenize_workers)
         eval(model, src_train_features, test_features, label_list, args)
 
 
@@ -1,6 +1,7 @@
 export GLUE_DIR=./data
 
-PYTHONPATH=../ CUDA_VISIBLE_DEVICES=0,1,2,3 python run_ld.py \
+# one process per GPU; --train_batch_size is per process, 4 x 12 = 48 in total
+PYTHONPATH=../ CUDA_VISIBLE_DEVICES=0,1,2,3 torchrun --nproc_per_node=4 run_ld.py \
   --task_name mld \
   --do_train \
   --do_eval \
@@ -9,7 +10,7 @@ PYTHONPATH=../ CUDA_VISIBLE_DEVICES=0,1,2,3 python run_ld.py \
   --data_dir $GLUE_DIR/MLDoc/ \
   --bert_model bert-base-multilingual-cased \
   --max_seq_length 128 \
-  --train_batch_size 48 \
+  --train_batch_size 12 \
   --learning_rate 2e-5 \
   --num_k 40 \
   --num_self_train 1 \